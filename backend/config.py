@@ -1,10 +1,31 @@
 import os
-from dotenv import load_dotenv
 
-load_dotenv()
+# .env files are a development convenience — skip the filesystem walk in
+# production, where the platform injects the environment directly.
+if os.environ.get("APP_ENV") != "production":
+    from dotenv import load_dotenv
 
-ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
-if not ANTHROPIC_API_KEY:
-    raise ValueError("ANTHROPIC_API_KEY environment variable is required")
+    load_dotenv()
 
-FRONTEND_ORIGIN = os.environ.get("FRONTEND_ORIGIN", "http://localhost:5173")
+_env = os.environ
+
+ANTHROPIC_API_KEY = _env.get("ANTHROPIC_API_KEY")
+FRONTEND_ORIGIN = _env.get("FRONTEND_ORIGIN", "http://localhost:5173")
+# Max concurrent Vision LLM calls per WebSocket connection
+MAX_INFLIGHT = int(_env.get("MAX_INFLIGHT", "32"))
+# Bind address for `python main.py`. Loopback by default: /enrich has no auth
+# and spends the Anthropic key, so only containers should set HOST=0.0.0.0.
+HOST = _env.get("HOST", "127.0.0.1")
+PORT = int(_env.get("PORT", "8000"))
+WEB_CONCURRENCY = int(_env.get("WEB_CONCURRENCY", "1"))
+
+# Report every missing variable in one message. The server still starts so
+# the frontend can be developed without a key; vision_llm falls back to
+# YOLO-label-only responses.
+_required = {"ANTHROPIC_API_KEY": ANTHROPIC_API_KEY}
+_missing = [name for name, value in _required.items() if not value]
+if _missing:
+    print(
+        f"Missing environment variables: {', '.join(_missing)} — "
+        "Vision LLM disabled, serving YOLO-label fallbacks"
+    )
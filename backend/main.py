@@ -2,17 +2,32 @@ import asyncio
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import ValidationError
+import msgspec
 
-from vision_llm import call_vision_llm
+from config import FRONTEND_ORIGIN, MAX_INFLIGHT
+from vision_llm import Batcher, call_vision_llm
 from models import EnrichmentRequest, EnrichmentResponse
 
-# Import config — will raise ValueError if ANTHROPIC_API_KEY missing.
-# We catch it so the server still starts during development without a key.
-try:
-    from config import FRONTEND_ORIGIN
-except ValueError:
-    FRONTEND_ORIGIN = "http://localhost:5173"
+# Shared across connections — msgspec encoders/decoders are stateless and
+# reusable. A typed Decoder compiles the request schema once, instead of
+# msgspec.json.decode(type=...) resolving it from its type cache per frame.
+_encoder = msgspec.json.Encoder()
+_request_decoder = msgspec.json.Decoder(EnrichmentRequest)
+
+# Pre-serialized error envelopes — trackId is a validated int, so %d is safe
+_ERROR_FRAME = b'{"error":true,"trackId":%d}'
+_BACKPRESSURE_FRAME = b'{"error":"backpressure","trackId":%d}'
+
+
+def _split_frame(frame: bytes) -> tuple[bytes, bytes]:
+    """Split a [4-byte big-endian header length][JSON header][JPEG] frame."""
+    if len(frame) < 4:
+        raise ValueError("frame too short")
+    body_start = 4 + int.from_bytes(frame[:4], "big")
+    if body_start >= len(frame):
+        raise ValueError("frame has no image body")
+    return frame[4:body_start], frame[body_start:]
+
 
 app = FastAPI(title="Vision Explorer Backend")
 
@@ -34,45 +49,85 @@ async def health_check():
 async def enrich(websocket: WebSocket):
     await websocket.accept()
     tasks: set[asyncio.Task] = set()
+    inflight = asyncio.Semaphore(MAX_INFLIGHT)
+    batcher = Batcher()
 
-    async def process_request(request: EnrichmentRequest):
+    async def process_request(request: EnrichmentRequest, jpeg_bytes: bytes):
         try:
-            result = await call_vision_llm(request.cropBase64, request.label)
+            async with inflight:
+                result = await call_vision_llm(jpeg_bytes, request.label, batcher)
+            # Already validated against LLMResult while parsing the reply
             response = EnrichmentResponse(
                 trackId=request.trackId,
-                **result,
+                identification=result.identification,
+                enrichment=result.enrichment,
             )
-            await websocket.send_json(response.model_dump())
+            await websocket.send_bytes(_encoder.encode(response))
         except (WebSocketDisconnect, RuntimeError):
             # Client already gone — nothing to send
             pass
         except Exception as exc:
             print(f"Error processing trackId {request.trackId}: {exc}")
             try:
-                await websocket.send_json({"error": True, "trackId": request.trackId})
+                await websocket.send_bytes(_ERROR_FRAME % request.trackId)
             except (WebSocketDisconnect, RuntimeError):
                 pass
 
     try:
         while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message["code"], message.get("reason"))
+
+            frame = message.get("bytes")
+            if frame is None:
+                print("Invalid request: expected a binary frame")
+                continue
             try:
-                data = await websocket.receive_json()
-                request = EnrichmentRequest(**data)
-            except (ValueError, ValidationError) as exc:
+                header, jpeg_bytes = _split_frame(frame)
+                request = _request_decoder.decode(header)
+            except ValueError as exc:
                 print(f"Invalid request: {exc}")
                 continue
 
+            # Shed load rather than queueing without bound: once every slot is
+            # busy and as many requests again are waiting, tell the client to
+            # resend later instead of holding the crop in memory.
+            if inflight.locked() and len(tasks) >= 2 * MAX_INFLIGHT:
+                await websocket.send_bytes(_BACKPRESSURE_FRAME % request.trackId)
+                continue
+
             # Fire off LLM call concurrently so the receive loop stays
             # responsive to WebSocket pings/pongs
-            task = asyncio.create_task(process_request(request))
+            task = asyncio.create_task(process_request(request, jpeg_bytes))
             tasks.add(task)
             task.add_done_callback(tasks.discard)
 
     except WebSocketDisconnect:
         print("Client disconnected")
     finally:
-        # Cancel any in-flight LLM calls for this connection
+        # Cancel this connection's requests. Each upstream LLM call stops once
+        # no other connection is waiting on the same crop.
         for t in tasks:
             t.cancel()
         if tasks:
             await asyncio.gather(*tasks, return_exceptions=True)
+        batcher.close()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    from config import HOST, PORT, WEB_CONCURRENCY
+
+    # uvloop where it is installed (not on Windows) + C HTTP parser; asyncio
+    # is single-threaded, so scale across cores with worker processes
+    uvicorn.run(
+        "main:app",
+        host=HOST,
+        port=PORT,
+        loop="auto",
+        http="httptools",
+        ws="websockets",
+        workers=WEB_CONCURRENCY,
+    )
@@ -1,14 +1,14 @@
-from pydantic import BaseModel
+import msgspec
 
 
-class EnrichmentRequest(BaseModel):
+class EnrichmentRequest(msgspec.Struct):
+    # JSON header of the binary frame; the raw JPEG crop follows it
     trackId: int
     label: str
     confidence: float
-    cropBase64: str
 
 
-class Identification(BaseModel):
+class Identification(msgspec.Struct):
     name: str
     brand: str | None
     model: str | None
@@ -17,21 +17,34 @@ class Identification(BaseModel):
     description: str
 
 
-class PriceEstimate(BaseModel):
+class PriceEstimate(msgspec.Struct):
     range_low: str
     range_high: str
     currency: str
     note: str
 
 
-class Enrichment(BaseModel):
+class Enrichment(msgspec.Struct):
     summary: str
     price_estimate: PriceEstimate
     specs: dict[str, str]
     search_query: str
 
 
-class EnrichmentResponse(BaseModel):
+class LLMResult(msgspec.Struct):
+    # Shape the Vision LLM is prompted to return; decoding into it validates
+    # the reply in the same pass as parsing
+    identification: Identification
+    enrichment: Enrichment
+
+
+class BatchResult(LLMResult):
+    # One element of a multi-image reply; ``image`` echoes the 1-based
+    # "Image N" it answers, so results are matched by number, not position
+    image: int
+
+
+class EnrichmentResponse(msgspec.Struct):
     trackId: int
     identification: Identification
     enrichment: Enrichment
@@ -0,0 +1,109 @@
+import asyncio
+import json
+import os
+
+import msgspec
+import pytest
+
+# Set before config loads so a developer's .env key never reaches the tests;
+# FakeMessages below stands in for the API
+os.environ["ANTHROPIC_API_KEY"] = ""
+
+import main  # noqa: E402
+import vision_llm  # noqa: E402
+
+
+def llm_reply(name: str) -> dict:
+    """A well-formed single-image reply identifying the crop as ``name``."""
+    reply = msgspec.to_builtins(vision_llm.FALLBACK_RESPONSE("object"))
+    reply["identification"]["name"] = name
+    reply["enrichment"]["summary"] = f"A {name}."
+    return reply
+
+
+def batch_reply(image: int, name: str) -> dict:
+    """One element of a multi-image reply, answering Image ``image``."""
+    return {"image": image, **llm_reply(name)}
+
+
+def image_count(messages: list[dict]) -> int:
+    return sum(block["type"] == "image" for block in messages[0]["content"])
+
+
+class FakeStream:
+    def __init__(
+        self, text: str, chunk_size: int, gate: asyncio.Event | None, hold_at: int
+    ):
+        self._text = text
+        self._chunk_size = chunk_size
+        self._gate = gate
+        self._hold_at = hold_at
+        self.cancelled = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    @property
+    def text_stream(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        try:
+            head, tail = self._text[: self._hold_at], self._text[self._hold_at :]
+            for i in range(0, len(head), self._chunk_size):
+                await asyncio.sleep(0)
+                yield head[i : i + self._chunk_size]
+            if self._gate is not None:
+                await self._gate.wait()
+            for i in range(0, len(tail), self._chunk_size):
+                await asyncio.sleep(0)
+                yield tail[i : i + self._chunk_size]
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+
+
+class FakeMessages:
+    """Stands in for ``client.messages``; ``reply(messages)`` returns the
+    streamed text or raises. Set ``gate`` to hold streams open until it is set,
+    after the first ``hold_at`` characters.
+    """
+
+    def __init__(self):
+        self.reply = lambda messages: json.dumps(llm_reply("Mug"))
+        self.chunk_size = 7
+        self.gate: asyncio.Event | None = None
+        self.hold_at = 0
+        self.calls: list[dict] = []
+        self.streams: list[FakeStream] = []
+
+    def stream(self, **kwargs):
+        self.calls.append(kwargs)
+        stream = FakeStream(
+            self.reply(kwargs["messages"]), self.chunk_size, self.gate, self.hold_at
+        )
+        self.streams.append(stream)
+        return stream
+
+
+@pytest.fixture(autouse=True)
+def fake_anthropic(monkeypatch):
+    fake = FakeMessages()
+    monkeypatch.setattr(vision_llm.client, "messages", fake)
+    vision_llm._CACHE.clear()
+    vision_llm._inflight.clear()
+    yield fake
+    vision_llm._CACHE.clear()
+    vision_llm._inflight.clear()
+
+
+@pytest.fixture
+def use_claude(monkeypatch):
+    """Route enrich() through the real Claude path, against the fake client.
+
+    Tests run without a key, so main is otherwise bound to _fallback_only.
+    """
+    monkeypatch.setattr(main, "call_vision_llm", vision_llm._call_claude)
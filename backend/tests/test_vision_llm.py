@@ -0,0 +1,376 @@
+import asyncio
+import base64
+import importlib
+import io
+import json
+import os
+import threading
+
+import anthropic
+import httpx
+import msgspec
+
+import pytest
+from PIL import Image
+
+import config
+import main
+import vision_llm
+from tests.conftest import batch_reply, image_count, llm_reply
+
+
+def make_jpeg(size: tuple[int, int], mode: str = "RGB", noise: bool = True) -> bytes:
+    # Noise defeats JPEG compression, so the crop lands above the byte threshold
+    if noise:
+        channels = len(Image.new(mode, (1, 1)).getbands())
+        image = Image.frombytes(mode, size, os.urandom(size[0] * size[1] * channels))
+    else:
+        image = Image.new(mode, size)
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+def sent_image(call: dict) -> Image.Image:
+    block = next(b for b in call["messages"][0]["content"] if b["type"] == "image")
+    return Image.open(io.BytesIO(base64.b64decode(block["source"]["data"])))
+
+
+def scan(chunks: list[str]) -> tuple[str, vision_llm._JsonEndScanner]:
+    """Feed chunks like _call_once does; return the text up to the close."""
+    scanner = vision_llm._JsonEndScanner()
+    parts = []
+    for chunk in chunks:
+        end = scanner.feed(chunk)
+        if end != -1:
+            parts.append(chunk[:end])
+            break
+        parts.append(chunk)
+    return "".join(parts), scanner
+
+
+def test_scanner_ignores_escaped_quotes_and_brackets_in_strings():
+    value = {"name": 'say \\"}]\\" and {[', "specs": {"k": "\\\\"}}
+    text = json.dumps(value)
+    # Split at every position so escapes straddle chunk boundaries
+    for split in range(1, len(text)):
+        received, _ = scan([text[:split], text[split:] + "\n\ntrailing {"])
+        assert json.loads(received) == value
+
+
+def test_scanner_skips_leading_fence():
+    value = {"a": "]}", "b": [1, {"c": 2}]}
+    text = "```json\n" + json.dumps(value) + "\n```"
+    received, _ = scan([text[i : i + 3] for i in range(0, len(text), 3)])
+    assert json.loads(vision_llm._strip_fences(received)) == value
+
+
+async def test_fenced_single_reply(fake_anthropic):
+    fake_anthropic.reply = lambda m: "```json\n" + json.dumps(llm_reply("Mug")) + "\n```"
+    result = await vision_llm._identify_one("aW1n", "cup")
+    assert result.identification.name == "Mug"
+
+
+async def test_stream_stops_at_object_close(fake_anthropic):
+    fake_anthropic.reply = lambda m: json.dumps(llm_reply("Mug")) + "\nHope this helps! {"
+    result = await vision_llm._identify_one("aW1n", "cup")
+    assert result.identification.name == "Mug"
+    assert fake_anthropic.calls[0]["max_tokens"] == 600
+
+
+@pytest.fixture
+async def batcher():
+    batcher = vision_llm.Batcher()
+    yield batcher
+    batcher.close()
+
+
+async def test_repeat_crop_is_served_from_cache(fake_anthropic, batcher):
+    first = await vision_llm._call_claude(b"crop", "cup", batcher)
+    second = await vision_llm._call_claude(b"crop", "cup", batcher)
+    assert first is second
+    assert len(fake_anthropic.calls) == 1
+
+
+async def test_cache_key_includes_label(fake_anthropic, batcher):
+    await vision_llm._call_claude(b"crop", "cup", batcher)
+    await vision_llm._call_claude(b"crop", "bottle", batcher)
+    assert len(fake_anthropic.calls) == 2
+
+
+async def test_invalid_reply_is_not_cached(fake_anthropic, batcher):
+    fake_anthropic.reply = lambda m: '{"identification": "oops"}'
+    first = await vision_llm._call_claude(b"crop", "cup", batcher)
+    assert first.identification.name == "cup"
+    assert not vision_llm._CACHE
+
+    fake_anthropic.reply = lambda m: json.dumps(llm_reply("Mug"))
+    second = await vision_llm._call_claude(b"crop", "cup", batcher)
+    third = await vision_llm._call_claude(b"crop", "cup", batcher)
+    assert second.identification.name == third.identification.name == "Mug"
+    # Two failed attempts, then one call; the third request hit the cache
+    assert len(fake_anthropic.calls) == 3
+
+
+def test_shrink_downscales_to_max_edge():
+    shrunk = Image.open(io.BytesIO(vision_llm._shrink(make_jpeg((1024, 768)))))
+    assert shrunk.size == (512, 384)
+    assert shrunk.format == "JPEG"
+
+
+def test_shrink_converts_cmyk_to_rgb():
+    shrunk = Image.open(io.BytesIO(vision_llm._shrink(make_jpeg((800, 800), "CMYK"))))
+    assert shrunk.mode == "RGB"
+    assert max(shrunk.size) == 512
+
+
+def test_shrink_keeps_small_images_as_is():
+    jpeg = make_jpeg((512, 300))
+    assert vision_llm._shrink(jpeg) is jpeg
+
+
+async def test_large_crop_is_shrunk_before_upload(fake_anthropic, batcher):
+    jpeg = make_jpeg((1024, 1024))
+    assert len(jpeg) >= vision_llm._SHRINK_MIN_BYTES
+    await vision_llm._call_claude(jpeg, "cup", batcher)
+    assert sent_image(fake_anthropic.calls[0]).size == (512, 512)
+
+
+async def test_small_crop_is_uploaded_untouched(fake_anthropic, batcher):
+    # Large in pixels but under the byte threshold: not worth re-encoding
+    jpeg = make_jpeg((1024, 1024), noise=False)
+    assert len(jpeg) < vision_llm._SHRINK_MIN_BYTES
+    await vision_llm._call_claude(jpeg, "cup", batcher)
+    assert sent_image(fake_anthropic.calls[0]).size == (1024, 1024)
+
+
+async def test_singleflight_shares_one_call(fake_anthropic, batcher):
+    fake_anthropic.gate = asyncio.Event()
+    waiters = [
+        asyncio.create_task(vision_llm._call_claude(b"crop", "cup", batcher))
+        for _ in range(3)
+    ]
+    await asyncio.sleep(0.05)
+    fake_anthropic.gate.set()
+    results = await asyncio.gather(*waiters)
+
+    assert len(fake_anthropic.calls) == 1
+    assert results[0] is results[1] is results[2]
+
+
+async def test_singleflight_survives_one_waiter_leaving(fake_anthropic, batcher):
+    fake_anthropic.gate = asyncio.Event()
+    leaving = asyncio.create_task(vision_llm._call_claude(b"crop", "cup", batcher))
+    staying = asyncio.create_task(vision_llm._call_claude(b"crop", "cup", batcher))
+    await asyncio.sleep(0.05)
+    leaving.cancel()
+    await asyncio.sleep(0)
+    fake_anthropic.gate.set()
+
+    assert (await staying).identification.name == "Mug"
+    assert len(fake_anthropic.calls) == 1
+
+
+async def test_singleflight_cancels_upstream_when_all_waiters_leave(
+    fake_anthropic, batcher
+):
+    fake_anthropic.gate = asyncio.Event()
+    waiters = [
+        asyncio.create_task(vision_llm._call_claude(b"crop", "cup", batcher))
+        for _ in range(2)
+    ]
+    await asyncio.sleep(0.05)
+    for waiter in waiters:
+        waiter.cancel()
+    await asyncio.gather(*waiters, return_exceptions=True)
+    await asyncio.sleep(0.01)
+
+    assert fake_anthropic.streams[0].cancelled
+    assert not vision_llm._inflight
+
+
+def test_keyless_process_binds_fallback():
+    assert vision_llm.call_vision_llm is vision_llm._fallback_only
+    assert main.call_vision_llm is vision_llm._fallback_only
+
+
+def test_keyed_process_binds_claude(monkeypatch):
+    try:
+        with monkeypatch.context() as m:
+            m.setattr(config, "ANTHROPIC_API_KEY", "sk-test")
+            importlib.reload(vision_llm)
+            assert vision_llm.call_vision_llm is vision_llm._call_claude
+    finally:
+        # Rebind against the real (empty) key for the rest of the session
+        importlib.reload(vision_llm)
+
+
+@pytest.mark.parametrize(
+    "mutate",
+    [
+        lambda r: r.pop("enrichment"),
+        lambda r: r["identification"].update(name=None),
+        lambda r: r["enrichment"].update(price_estimate="$5"),
+        lambda r: r["enrichment"].update(specs=["not", "a", "map"]),
+    ],
+)
+def test_reply_decoder_rejects_nested_bad_shapes(mutate):
+    reply = llm_reply("Mug")
+    mutate(reply)
+    with pytest.raises(msgspec.ValidationError):
+        vision_llm._reply_decoder.decode(json.dumps(reply))
+
+
+def test_prompt_block_is_a_text_block():
+    assert vision_llm._prompt_block("cup") == {
+        "type": "text",
+        "text": vision_llm._get_prompt("cup"),
+    }
+
+
+async def test_shared_call_outlives_the_starting_connection(
+    fake_anthropic, monkeypatch
+):
+    # The flight uses the batcher of the connection that started it. Hold it
+    # in _shrink while that connection leaves and closes its batcher.
+    release_shrink = threading.Event()
+    real_shrink = vision_llm._shrink
+
+    def held_shrink(jpeg_bytes):
+        release_shrink.wait(5)
+        return real_shrink(jpeg_bytes)
+
+    batcher_a, batcher_b = vision_llm.Batcher(), vision_llm.Batcher()
+    # Serve one crop first so A's collector is running
+    await vision_llm._call_claude(b"small", "cup", batcher_a)
+
+    monkeypatch.setattr(vision_llm, "_shrink", held_shrink)
+    jpeg = make_jpeg((1024, 1024))
+    a = asyncio.create_task(vision_llm._call_claude(jpeg, "cup", batcher_a))
+    b = asyncio.create_task(vision_llm._call_claude(jpeg, "cup", batcher_b))
+    await asyncio.sleep(0.01)
+    a.cancel()
+    await asyncio.gather(a, return_exceptions=True)
+    batcher_a.close()
+    release_shrink.set()
+
+    result = await asyncio.wait_for(b, timeout=2)
+    assert result.identification.name == "Mug"
+    batcher_b.close()
+
+
+def test_scanner_records_array_elements_as_they_close():
+    items = [{"a": "]}"}, "skip", 3, {"b": [1, {"c": 2}]}]
+    text = "```json\n" + json.dumps(items) + "\n```"
+    received, scanner = scan([text[i : i + 3] for i in range(0, len(text), 3)])
+    assert json.loads(vision_llm._strip_fences(received)) == items
+    assert [json.loads(received[a:b]) for a, b in scanner.elements] == [
+        items[0],
+        items[3],
+    ]
+
+
+async def gather_batch(*crops: bytes) -> list[str]:
+    batcher = vision_llm.Batcher()
+    try:
+        results = await asyncio.gather(
+            *(vision_llm._call_claude(crop, "cup", batcher) for crop in crops)
+        )
+    finally:
+        batcher.close()
+    return [r.identification.name for r in results]
+
+
+async def test_batch_matches_elements_by_image_number(fake_anthropic):
+    # Out of order on purpose: the echoed number, not position, decides
+    elements = [batch_reply(3, "Phone"), batch_reply(1, "Mug"), batch_reply(2, "Bottle")]
+    fake_anthropic.reply = lambda m: json.dumps(elements)
+
+    assert await gather_batch(b"1", b"2", b"3") == ["Mug", "Bottle", "Phone"]
+    assert len(fake_anthropic.calls) == 1
+    assert image_count(fake_anthropic.calls[0]["messages"]) == 3
+
+
+async def test_batch_resolves_crops_before_the_array_closes(fake_anthropic):
+    first = json.dumps(batch_reply(1, "Mug"))
+    fake_anthropic.reply = lambda m: (
+        "[" + first + ", " + json.dumps(batch_reply(2, "Bottle")) + "]"
+    )
+    # Hold the stream just after the first element closes
+    fake_anthropic.hold_at = 1 + len(first)
+    fake_anthropic.gate = asyncio.Event()
+    batcher = vision_llm.Batcher()
+    one = asyncio.create_task(vision_llm._call_claude(b"1", "cup", batcher))
+    two = asyncio.create_task(vision_llm._call_claude(b"2", "cup", batcher))
+
+    assert (await asyncio.wait_for(one, timeout=1)).identification.name == "Mug"
+    assert not two.done()
+    fake_anthropic.gate.set()
+    assert (await two).identification.name == "Bottle"
+    batcher.close()
+
+
+@pytest.mark.parametrize(
+    "elements, expected",
+    [
+        # Too few: the model skipped Image 1, so it must not get Image 2's answer
+        ([batch_reply(2, "Bottle")], ["Single", "Bottle", "Single"]),
+        # Too many: matched by number, so the extra can't shift the others
+        (
+            [batch_reply(n, name) for n, name in enumerate(["A", "B", "C", "D"], 1)],
+            ["A", "B", "C"],
+        ),
+        # No image number: can't be matched by position
+        ([llm_reply("Mug"), llm_reply("Bottle"), llm_reply("Phone")], ["Single"] * 3),
+        # Scalar and out-of-range elements are skipped; the rest still match
+        (
+            ["oops", batch_reply(2, "Bottle"), batch_reply(9, "Wrong")],
+            ["Single", "Bottle", "Single"],
+        ),
+        # Wrong shape for one crop; a repeat can't override the first answer
+        (
+            [
+                batch_reply(1, "Mug"),
+                {"image": 2, "identification": 3},
+                batch_reply(3, "Phone"),
+                batch_reply(1, "Wrong"),
+            ],
+            ["Mug", "Single", "Phone"],
+        ),
+    ],
+)
+async def test_unmatched_crops_fall_back_per_crop(fake_anthropic, elements, expected):
+    def reply(messages):
+        if image_count(messages) > 1:
+            return json.dumps(elements)
+        return json.dumps(llm_reply("Single"))
+
+    fake_anthropic.reply = reply
+    assert await gather_batch(b"1", b"2", b"3") == expected
+
+
+def api_error(cls: type[anthropic.APIStatusError], status: int) -> Exception:
+    request = httpx.Request("POST", "https://api.anthropic.com/v1/messages")
+    return cls("error", response=httpx.Response(status, request=request), body=None)
+
+
+async def test_bad_request_falls_back_per_crop(fake_anthropic):
+    def reply(messages):
+        if image_count(messages) > 1:
+            raise api_error(anthropic.BadRequestError, 400)
+        return json.dumps(llm_reply("Single"))
+
+    fake_anthropic.reply = reply
+    assert await gather_batch(b"1", b"2") == ["Single", "Single"]
+    assert len(fake_anthropic.calls) == 3
+
+
+async def test_rate_limit_fails_the_whole_batch(fake_anthropic):
+    def reply(messages):
+        raise api_error(anthropic.RateLimitError, 429)
+
+    fake_anthropic.reply = reply
+    with pytest.raises(anthropic.RateLimitError):
+        await gather_batch(b"1", b"2")
+    # Retrying each crop would only hit the limit again
+    assert len(fake_anthropic.calls) == 1
@@ -0,0 +1,100 @@
+import asyncio
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from tests.conftest import llm_reply
+
+
+def encode_frame(header: dict, jpeg: bytes) -> bytes:
+    header_bytes = json.dumps(header).encode()
+    return len(header_bytes).to_bytes(4, "big") + header_bytes + jpeg
+
+
+def test_split_frame():
+    header, jpeg = main._split_frame(encode_frame({"trackId": 1}, b"\xff\xd8jpeg"))
+    assert json.loads(header) == {"trackId": 1}
+    assert jpeg == b"\xff\xd8jpeg"
+
+
+@pytest.mark.parametrize(
+    "frame",
+    [
+        b"",
+        b"\x00\x00\x00",
+        b"\x00\x00\x00\x00",
+        b"\x00\x00\x00\x02{}",
+        b"\x00\x00\x01\x00{}",
+    ],
+)
+def test_split_frame_rejects_short_frames(frame):
+    with pytest.raises(ValueError):
+        main._split_frame(frame)
+
+
+def test_enrich_round_trip(use_claude, fake_anthropic):
+    header = {"trackId": 7, "label": "cup", "confidence": 0.9}
+    with TestClient(main.app) as client, client.websocket_connect("/enrich") as ws:
+        ws.send_bytes(encode_frame(header, b"\xff\xd8jpeg"))
+        response = json.loads(ws.receive_bytes())
+
+    assert response == {"trackId": 7, **llm_reply("Mug")}
+    # The raw JPEG reaches the SDK base64-encoded exactly once
+    image = fake_anthropic.calls[0]["messages"][0]["content"][0]
+    assert image["source"]["data"] == "/9hqcGVn"
+
+
+def test_enrich_skips_invalid_frames(use_claude):
+    good = encode_frame({"trackId": 2, "label": "cup", "confidence": 0.9}, b"jpeg")
+    with TestClient(main.app) as client, client.websocket_connect("/enrich") as ws:
+        ws.send_text("not a binary frame")
+        ws.send_bytes(b"\x00\x00")
+        ws.send_bytes(encode_frame({"trackId": "nope"}, b"jpeg"))
+        ws.send_bytes(good)
+        response = json.loads(ws.receive_bytes())
+
+    # The invalid frames are dropped without a reply; the next one is served
+    assert response["trackId"] == 2
+
+
+def test_enrich_sheds_load_beyond_twice_max_inflight(
+    use_claude, fake_anthropic, monkeypatch
+):
+    monkeypatch.setattr(main, "MAX_INFLIGHT", 1)
+    # Hold the upstream call open so the single slot stays busy
+    fake_anthropic.gate = asyncio.Event()
+    with TestClient(main.app) as client, client.websocket_connect("/enrich") as ws:
+        for track_id in (1, 2, 3):
+            header = {"trackId": track_id, "label": "cup", "confidence": 0.9}
+            ws.send_bytes(encode_frame(header, b"jpeg%d" % track_id))
+        response = json.loads(ws.receive_bytes())
+
+    # One request running and one waiting; the third is shed
+    assert response == {"error": "backpressure", "trackId": 3}
+
+
+def test_enrich_without_key_serves_fallback(fake_anthropic):
+    header = {"trackId": 4, "label": "cup", "confidence": 0.9}
+    with TestClient(main.app) as client, client.websocket_connect("/enrich") as ws:
+        ws.send_bytes(encode_frame(header, b"jpeg"))
+        response = json.loads(ws.receive_bytes())
+
+    assert response["trackId"] == 4
+    assert response["identification"]["name"] == "cup"
+    # The keyless binding never reaches the API
+    assert fake_anthropic.calls == []
+
+
+def test_enrich_falls_back_on_malformed_reply(use_claude, fake_anthropic):
+    fake_anthropic.reply = lambda messages: '{"identification": "oops"}'
+    header = {"trackId": 3, "label": "cup", "confidence": 0.9}
+    with TestClient(main.app) as client, client.websocket_connect("/enrich") as ws:
+        ws.send_bytes(encode_frame(header, b"jpeg"))
+        response = json.loads(ws.receive_bytes())
+
+    assert response["trackId"] == 3
+    assert response["identification"]["name"] == "cup"
+    # Original call plus one retry
+    assert len(fake_anthropic.calls) == 2
@@ -1,31 +1,54 @@
-import json
-import re
+import asyncio
+import base64
+import functools
+import hashlib
+import io
+from collections.abc import Awaitable
 
 import anthropic
+from cachetools import LRUCache
+import msgspec
+from PIL import Image
+
+from config import ANTHROPIC_API_KEY
+from models import BatchResult, Enrichment, Identification, LLMResult, PriceEstimate
+
+# One pooled HTTP/2 client for the process: concurrent enrichment calls are
+# multiplexed over a warm TLS connection instead of each opening its own.
+# The SDK's default pool limits (1000 max / 100 keep-alive) already exceed
+# what a single worker can drive, so only the protocol and timeouts change.
+client = anthropic.AsyncAnthropic(
+    api_key=ANTHROPIC_API_KEY,
+    http_client=anthropic.DefaultAsyncHttpxClient(
+        http2=True,
+        timeout=anthropic.Timeout(60.0, connect=5.0),
+    )
+)
+
+# Label-independent parts of the fallback, shared by every fallback result.
+# Read-only by convention — copy before mutating.
+_FALLBACK_PRICE = PriceEstimate(range_low="", range_high="", currency="USD", note="")
+_FALLBACK_SPECS: dict[str, str] = {}
+
+
+def FALLBACK_RESPONSE(yolo_label: str) -> LLMResult:
+    return LLMResult(
+        identification=Identification(
+            name=yolo_label,
+            brand=None,
+            model=None,
+            color="unknown",
+            category=yolo_label,
+            description=yolo_label,
+        ),
+        enrichment=Enrichment(
+            summary="",
+            price_estimate=_FALLBACK_PRICE,
+            specs=_FALLBACK_SPECS,
+            search_query=yolo_label,
+        ),
+    )
 
-client = anthropic.AsyncAnthropic()
-
-FALLBACK_RESPONSE = lambda yolo_label: {
-    "identification": {
-        "name": yolo_label,
-        "brand": None,
-        "model": None,
-        "color": "unknown",
-        "category": yolo_label,
-        "description": yolo_label,
-    },
-    "enrichment": {
-        "summary": "",
-        "price_estimate": {
-            "range_low": "",
-            "range_high": "",
-            "currency": "USD",
-            "note": "",
-        },
-        "specs": {},
-        "search_query": yolo_label,
-    },
-}
 
 PRODUCT_PROMPT = """YOLO detected this as: "{label}".
 
@@ -95,66 +118,475 @@ Describe what this person is doing, their context, and any notable objects they
 
 Return raw JSON only, no markdown fences."""
 
+BATCH_PROMPT = """You are given {count} images, labelled "Image 1" to "Image {count}" in order. Answer each image using the instructions for its number below.
+
+{sections}
+
+---
+
+Return ONLY a JSON array of exactly {count} objects, one per image in order. Each object is the JSON object requested for its image, plus a top-level "image" field set to that image's number (1 to {count}). Return raw JSON only, no markdown fences."""
+
 # Labels that should use the person-aware prompt
 PERSON_LABELS = frozenset(["person"])
 
 
+# COCO has 80 classes, so every label's prompt is formatted once per process
+@functools.lru_cache(maxsize=128)
 def _get_prompt(yolo_label: str) -> str:
     if yolo_label in PERSON_LABELS:
         return PERSON_PROMPT
     return PRODUCT_PROMPT.format(label=yolo_label)
 
 
+@functools.lru_cache(maxsize=128)
+def _get_batch_prompt(yolo_labels: tuple[str, ...]) -> str:
+    # Each distinct prompt appears once, listing the images it applies to
+    groups: dict[str, list[str]] = {}
+    for index, label in enumerate(yolo_labels, 1):
+        groups.setdefault(_get_prompt(label), []).append(str(index))
+    sections = "\n\n---\n\n".join(
+        f"Instructions for Image {', '.join(indexes)}:\n\n{prompt}"
+        for prompt, indexes in groups.items()
+    )
+    return BATCH_PROMPT.format(count=len(yolo_labels), sections=sections)
+
+
 def _strip_fences(text: str) -> str:
     """Strip markdown code fences if present."""
     text = text.strip()
-    text = re.sub(r"^```(?:json)?\s*", "", text)
-    text = re.sub(r"\s*```$", "", text)
+    if text.startswith("```"):
+        text = text[3:]
+        if text.startswith("json"):
+            text = text[4:]
+    if text.endswith("```"):
+        text = text[:-3]
     return text.strip()
 
 
-async def _call_once(crop_base64: str, yolo_label: str) -> dict:
-    response = await client.messages.create(
+# Claude downsamples large images anyway; 512px on the long edge is plenty for
+# identification and keeps uploads small. Tiny crops aren't worth re-encoding.
+_MAX_IMAGE_EDGE = 512
+_SHRINK_MIN_BYTES = 32 * 1024
+
+
+def _shrink(jpeg_bytes: bytes) -> bytes:
+    """Downscale a JPEG to _MAX_IMAGE_EDGE and re-encode at quality 80."""
+    image = Image.open(io.BytesIO(jpeg_bytes))
+    if max(image.size) <= _MAX_IMAGE_EDGE:
+        return jpeg_bytes
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    image.thumbnail((_MAX_IMAGE_EDGE, _MAX_IMAGE_EDGE), Image.Resampling.BILINEAR)
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=80)
+    return out.getvalue()
+
+
+# The text block depends only on the label, so it is built once per label and
+# shared by every request. Per call only the image block is new. The shared
+# dict is not patched in place, because concurrent calls would race between
+# awaits before the SDK serializes the body.
+@functools.lru_cache(maxsize=128)
+def _prompt_block(yolo_label: str) -> dict:
+    return {"type": "text", "text": _get_prompt(yolo_label)}
+
+
+def _image_block(image_base64: str) -> dict:
+    return {
+        "type": "image",
+        "source": {
+            "type": "base64",
+            "media_type": "image/jpeg",
+            "data": image_base64,
+        },
+    }
+
+
+def _build_messages(image_base64: str, yolo_label: str) -> list[dict]:
+    return [
+        {
+            "role": "user",
+            "content": [_image_block(image_base64), _prompt_block(yolo_label)],
+        }
+    ]
+
+
+def _build_batch_messages(items: list[tuple[str, str]]) -> list[dict]:
+    content: list[dict] = []
+    for index, (image_base64, _) in enumerate(items, 1):
+        content.append({"type": "text", "text": f"Image {index}:"})
+        content.append(_image_block(image_base64))
+    labels = tuple(label for _, label in items)
+    content.append({"type": "text", "text": _get_batch_prompt(labels)})
+    return [{"role": "user", "content": content}]
+
+
+# A typed decoder parses and validates LLM replies in one pass, so a reply
+# with the wrong shape raises DecodeError (and is retried) instead of being
+# cached or reaching the client. Batch replies are decoded element by element.
+_reply_decoder = msgspec.json.Decoder(LLMResult)
+_batch_element_decoder = msgspec.json.Decoder(BatchResult)
+
+
+class _JsonEndScanner:
+    """Tracks bracket depth across streamed chunks to find where the first
+    top-level JSON value closes. Brackets inside strings are ignored.
+
+    When that value is an array, the span of each object or array element is
+    appended to ``elements`` as soon as it closes, as offsets into the
+    concatenation of every chunk fed. Scalar elements are skipped.
+    """
+
+    def __init__(self) -> None:
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+        self.is_array = False
+        self.offset = 0
+        self.element_start = 0
+        self.elements: list[tuple[int, int]] = []
+
+    def feed(self, chunk: str) -> int:
+        """Return the index just past the closing bracket in chunk, or -1."""
+        base = self.offset
+        self.offset += len(chunk)
+        for i, ch in enumerate(chunk):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch in "{[":
+                if not self.started:
+                    self.started = True
+                    self.is_array = ch == "["
+                elif self.depth == 1 and self.is_array:
+                    self.element_start = base + i
+                self.depth += 1
+            elif not self.started:
+                continue
+            elif ch in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    return i + 1
+                if self.depth == 1 and self.is_array:
+                    self.elements.append((self.element_start, base + i + 1))
+            elif ch == '"':
+                self.in_string = True
+        return -1
+
+
+def _open_stream(messages: list[dict], max_tokens: int):
+    return client.messages.stream(
         model="claude-sonnet-4-20250514",
-        max_tokens=600,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": "image/jpeg",
-                            "data": crop_base64,
-                        },
-                    },
-                    {
-                        "type": "text",
-                        "text": _get_prompt(yolo_label),
-                    },
-                ],
-            }
-        ],
+        max_tokens=max_tokens,
+        messages=messages,
     )
-    raw = response.content[0].text
-    return json.loads(_strip_fences(raw))
 
 
-async def call_vision_llm(crop_base64: str, yolo_label: str) -> dict:
-    """Call Claude Vision LLM and return identification + enrichment as a dict.
+async def _call_once(image_base64: str, yolo_label: str) -> LLMResult:
+    # Stream the reply and stop reading as soon as the JSON object closes,
+    # rather than waiting for trailing tokens and the end-of-message events
+    parts: list[str] = []
+    scanner = _JsonEndScanner()
+    async with _open_stream(_build_messages(image_base64, yolo_label), 600) as stream:
+        async for text in stream.text_stream:
+            end = scanner.feed(text)
+            if end != -1:
+                parts.append(text[:end])
+                break
+            parts.append(text)
+    return _reply_decoder.decode(_strip_fences("".join(parts)))
 
-    Retries once on JSON parse failure, then falls back to a minimal dict.
+
+_BatchItem = tuple[str, str, asyncio.Future]
+
+
+async def _call_batch(batch: list[_BatchItem]) -> None:
+    """Stream a multi-image reply, resolving each crop's future as soon as its
+    array element closes rather than after the whole array.
+
+    Each element names the image it answers, so a short, long or reordered
+    array can't hand one crop another's result. Crops with no valid element
+    naming them are left unresolved for the caller to retry one by one.
     """
+    messages = _build_batch_messages([(image, label) for image, label, _ in batch])
+    received = ""
+    scanner = _JsonEndScanner()
+    seen = 0
+    pending = len(batch)
+    async with _open_stream(messages, 600 * len(batch)) as stream:
+        async for text in stream.text_stream:
+            end = scanner.feed(text)
+            received += text if end == -1 else text[:end]
+            for start, stop in scanner.elements[seen:]:
+                seen += 1
+                try:
+                    element = _batch_element_decoder.decode(received[start:stop])
+                except msgspec.DecodeError:
+                    continue
+                if not 1 <= element.image <= len(batch):
+                    continue
+                future = batch[element.image - 1][2]
+                # First answer for an image wins; a repeat can't override it
+                if not future.done():
+                    future.set_result(element)
+                    pending -= 1
+            if end != -1 or pending == 0:
+                break
+
+
+async def _identify_one(image_base64: str, yolo_label: str) -> LLMResult | None:
+    """Call the LLM, retrying once on a malformed reply. None if both fail."""
     try:
-        return await _call_once(crop_base64, yolo_label)
-    except (json.JSONDecodeError, ValueError, KeyError):
+        return await _call_once(image_base64, yolo_label)
+    except (msgspec.DecodeError, ValueError, KeyError):
         pass
 
     # Retry once
     try:
-        return await _call_once(crop_base64, yolo_label)
-    except (json.JSONDecodeError, ValueError, KeyError):
+        return await _call_once(image_base64, yolo_label)
+    except (msgspec.DecodeError, ValueError, KeyError):
         pass
 
+    return None
+
+
+async def _settle(future: asyncio.Future, coro: Awaitable[LLMResult | None]) -> None:
+    try:
+        result = await coro
+    except Exception as exc:
+        if not future.done():
+            future.set_exception(exc)
+    else:
+        if not future.done():
+            future.set_result(result)
+
+
+def _fail(batch: list[_BatchItem], exc: Exception) -> None:
+    for *_, future in batch:
+        if not future.done():
+            future.set_exception(exc)
+
+
+async def _dispatch(batch: list[_BatchItem]) -> None:
+    batch = [item for item in batch if not item[2].done()]
+    if not batch:
+        return
+    if len(batch) == 1:
+        # Nothing to amortise — use the single-image prompt
+        image_base64, yolo_label, future = batch[0]
+        await _settle(future, _identify_one(image_base64, yolo_label))
+        return
+
+    try:
+        await _call_batch(batch)
+    except anthropic.APIStatusError as exc:
+        # 400/413 usually means one bad or oversized crop; retrying each crop
+        # on its own confines the failure to it. Anything else (auth, rate
+        # limits, overload) would fail the per-crop calls too.
+        if exc.status_code not in (400, 413):
+            _fail(batch, exc)
+            return
+    except Exception as exc:
+        _fail(batch, exc)
+        return
+
+    # Whatever the batch reply didn't resolve gets its own single-image call
+    leftovers = [item for item in batch if not item[2].done()]
+    await asyncio.gather(
+        *(
+            _settle(future, _identify_one(image, label))
+            for image, label, future in leftovers
+        )
+    )
+
+
+# Requests arriving within one window are sent to Claude as a single
+# multi-image message. A frame's crops reach the backend within a few ms of
+# each other, and the window is small next to a 1-2s LLM call. The max batch
+# size matches the frontend's overlay cap.
+_BATCH_WINDOW_S = 0.02
+_BATCH_MAX_SIZE = 8
+
+
+class Batcher:
+    """Groups one connection's crops arriving within _BATCH_WINDOW_S into a
+    single multi-image request.
+
+    One per WebSocket connection, so a prompt never mixes different clients'
+    images.
+    """
+
+    def __init__(self) -> None:
+        self._queue: asyncio.Queue[_BatchItem] = asyncio.Queue()
+        self._collector: asyncio.Task | None = None
+        self._dispatching: set[asyncio.Task] = set()
+        self._closed = False
+
+    async def submit(self, image_base64: str, yolo_label: str) -> LLMResult | None:
+        future = asyncio.get_running_loop().create_future()
+        item = (image_base64, yolo_label, future)
+        if self._closed:
+            # A call shared with another connection (see _inflight) can
+            # outlive the connection that started it; nothing collects any
+            # more, so send the crop on its own
+            self._dispatch([item])
+        else:
+            if self._collector is None:
+                self._collector = asyncio.create_task(self._collect())
+            self._queue.put_nowait(item)
+        return await future
+
+    def close(self) -> None:
+        """Stop collecting. Crops already submitted, or submitted later by a
+        call another connection still shares, are still dispatched.
+        """
+        self._closed = True
+        if self._collector is not None:
+            self._collector.cancel()
+        while not self._queue.empty():
+            self._dispatch(self._take(_BATCH_MAX_SIZE))
+
+    async def _collect(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            try:
+                await asyncio.sleep(_BATCH_WINDOW_S)
+            finally:
+                # Also runs on close(), so a crop already taken off the queue
+                # is never dropped
+                self._dispatch(batch + self._take(_BATCH_MAX_SIZE - 1))
+
+    def _take(self, limit: int) -> list[_BatchItem]:
+        items: list[_BatchItem] = []
+        while len(items) < limit and not self._queue.empty():
+            items.append(self._queue.get_nowait())
+        return items
+
+    def _dispatch(self, batch: list[_BatchItem]) -> None:
+        # Dispatch without waiting so the next window starts collecting now
+        task = asyncio.create_task(_dispatch(batch))
+        self._dispatching.add(task)
+        task.add_done_callback(self._dispatching.discard)
+
+        # Once every caller in the batch has gone, stop the upstream call
+        futures = [future for *_, future in batch]
+
+        def cancel_if_abandoned(_: asyncio.Future) -> None:
+            if all(future.cancelled() for future in futures):
+                task.cancel()
+
+        for future in futures:
+            future.add_done_callback(cancel_if_abandoned)
+
+
+async def _identify(
+    jpeg_bytes: bytes, yolo_label: str, batcher: Batcher
+) -> LLMResult | None:
+    """Identify one crop via the batcher. None if the LLM reply was unusable."""
+    if len(jpeg_bytes) >= _SHRINK_MIN_BYTES:
+        # Pillow releases the GIL while decoding/resizing — keep it off the loop
+        jpeg_bytes = await asyncio.to_thread(_shrink, jpeg_bytes)
+    # The API only accepts base64 image data — encode once, at the SDK boundary
+    image_base64 = base64.b64encode(jpeg_bytes).decode("ascii")
+    return await batcher.submit(image_base64, yolo_label)
+
+
+# Validated results by (crop bytes, label). Only replies that decoded into
+# LLMResult are stored; fallbacks never are, so a transient bad reply doesn't
+# stick to an image. Cached results are shared and must not be mutated.
+#
+# Hits need byte-identical crops. Live camera crops almost never repeat, and
+# the client never resends a trackId, so this only catches exact resends
+# (e.g. a static test image or a retried upload). It is kept small.
+_CACHE: LRUCache[bytes, LLMResult] = LRUCache(maxsize=256)
+
+
+class _Flight:
+    """One upstream task shared by every concurrent caller for a key."""
+
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task) -> None:
+        self.task = task
+        self.waiters = 0
+
+
+# Singleflight table: one in-flight call per crop + label. The call is
+# cancelled once its last waiter leaves, so abandoned work stops upstream.
+_inflight: dict[bytes, _Flight] = {}
+
+
+def _cache_key(jpeg_bytes: bytes, yolo_label: str) -> bytes:
+    h = hashlib.blake2b(yolo_label.encode() + b"\0", digest_size=16)
+    h.update(jpeg_bytes)
+    return h.digest()
+
+
+async def _fetch(
+    key: bytes, jpeg_bytes: bytes, yolo_label: str, batcher: Batcher
+) -> LLMResult:
+    result = await _identify(jpeg_bytes, yolo_label, batcher)
+    if result is None:
+        return FALLBACK_RESPONSE(yolo_label)
+    _CACHE[key] = result
+    return result
+
+
+async def _call_claude(
+    jpeg_bytes: bytes, yolo_label: str, batcher: Batcher
+) -> LLMResult:
+    """Call Claude Vision LLM and return identification + enrichment.
+
+    Byte-identical crops are served from a small in-process LRU cache (rarely
+    hit with live camera frames, see _CACHE), concurrent identical requests
+    share one upstream call (cancelled once every caller has left), and a
+    connection's requests landing in the same short window are batched into
+    one multi-image call via its ``batcher``. Retries once on an invalid
+    reply, then falls back to a YOLO-label-only result.
+    """
+    key = _cache_key(jpeg_bytes, yolo_label)
+    cached = _CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    flight = _inflight.get(key)
+    if flight is None:
+        task = asyncio.create_task(_fetch(key, jpeg_bytes, yolo_label, batcher))
+        flight = _inflight[key] = _Flight(task)
+        task.add_done_callback(functools.partial(_land, key, flight))
+
+    flight.waiters += 1
+    try:
+        # Shielded so one caller leaving doesn't cancel the call for the rest
+        return await asyncio.shield(flight.task)
+    finally:
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            # Nobody is left to read the result; new callers start afresh
+            _inflight.pop(key, None)
+            flight.task.cancel()
+
+
+def _land(key: bytes, flight: _Flight, task: asyncio.Task) -> None:
+    if _inflight.get(key) is flight:
+        del _inflight[key]
+    # Retrieve the exception so a call whose waiters have all left doesn't
+    # log "Task exception was never retrieved"
+    if not task.cancelled():
+        task.exception()
+
+
+async def _fallback_only(
+    jpeg_bytes: bytes, yolo_label: str, batcher: Batcher
+) -> LLMResult:
     return FALLBACK_RESPONSE(yolo_label)
+
+
+# Without a key every upstream call would fail, so dev/CI runs skip straight
+# to the YOLO-label fallback instead of walking the retry ladder.
+call_vision_llm = _call_claude if ANTHROPIC_API_KEY else _fallback_only
@@ -1,16 +1,20 @@
 import { useEffect, useRef, useState } from "react";
 import type { RefObject } from "react";
-import type { EnrichmentResponse, WebSocketMessage } from "../types/index";
+import type { EnrichmentResponse, EnrichmentRequestHeader } from "../types/index";
 import {
   WEBSOCKET_URL,
   ENRICHMENT_CONFIDENCE_THRESHOLD,
   STABILITY_THRESHOLD_MS,
 } from "../lib/constants";
+import { encodeFrameHeader } from "../lib/framing";
 import { useStore } from "../store/useStore";
 
 // Exponential backoff delays in ms (last value repeats)
 const BACKOFF_DELAYS = [1000, 2000, 4000, 8000, 10000];
 
+// Backend replies arrive as binary frames carrying UTF-8 JSON
+const textDecoder = new TextDecoder();
+
 type ConnectionStatus = "connected" | "reconnecting" | "disconnected";
 
 export function useEnrichment(
@@ -24,6 +28,11 @@ export function useEnrichment(
   const reconnectTimeoutRef = useRef<ReturnType<typeof setTimeout> | null>(null);
   const reconnectAttemptsRef = useRef(0);
   const isMountedRef = useRef(false);
+  // Per-track backpressure cooldown: the gate skips a track until retryAfter,
+  // and each further shed request for it moves one step up BACKOFF_DELAYS
+  const backpressureRef = useRef(
+    new Map<number, { retryAfter: number; attempts: number }>()
+  );
 
   // Read the Map directly — stable reference per store update (no new array allocation).
   const trackedObjects = useStore((s) => s.trackedObjects);
@@ -49,6 +58,7 @@ export function useEnrichment(
       if (!isMountedRef.current) return;
 
       const ws = new WebSocket(WEBSOCKET_URL);
+      ws.binaryType = "arraybuffer";
       wsRef.current = ws;
 
       ws.onopen = () => {
@@ -61,7 +71,28 @@ export function useEnrichment(
       ws.onmessage = (event: MessageEvent) => {
         if (!isMountedRef.current) return;
         try {
-          const data = JSON.parse(event.data as string);
+          const text =
+            typeof event.data === "string"
+              ? event.data
+              : textDecoder.decode(event.data as ArrayBuffer);
+          const data = JSON.parse(text);
+          // Backend shed the request under load — reset so the gate resends
+          // it, but only after a cooldown so a loaded backend isn't hammered
+          if (data.error === "backpressure" && data.trackId != null) {
+            const prev = backpressureRef.current.get(data.trackId);
+            const attempts = prev ? prev.attempts + 1 : 0;
+            const delay =
+              BACKOFF_DELAYS[Math.min(attempts, BACKOFF_DELAYS.length - 1)];
+            backpressureRef.current.set(data.trackId, {
+              retryAfter: Date.now() + delay,
+              attempts,
+            });
+            setEnrichmentStateRef.current(data.trackId, "none");
+            return;
+          }
+          if (data.trackId != null) {
+            backpressureRef.current.delete(data.trackId);
+          }
           // Backend sends { error: true, trackId } on Vision LLM failure
           if (data.error && data.trackId != null) {
             setEnrichmentStateRef.current(data.trackId, "error");
@@ -121,12 +152,21 @@ export function useEnrichment(
     if (!sampleCanvas || sampleCanvas.width === 0 || sampleCanvas.height === 0)
       return;
 
+    // Forget cooldowns for tracks that have left the scene
+    const backpressure = backpressureRef.current;
+    for (const trackId of backpressure.keys()) {
+      if (!trackedObjects.has(trackId)) backpressure.delete(trackId);
+    }
+
+    const now = Date.now();
     for (const obj of trackedObjects.values()) {
-      // Gating conditions: high confidence, stable 2s, not yet enriched
+      // Gating conditions: high confidence, stable 2s, not yet enriched,
+      // not cooling down after backpressure
       if (
         obj.confidence <= ENRICHMENT_CONFIDENCE_THRESHOLD ||
-        Date.now() - obj.firstSeen < STABILITY_THRESHOLD_MS ||
-        obj.enrichmentState !== "none"
+        now - obj.firstSeen < STABILITY_THRESHOLD_MS ||
+        obj.enrichmentState !== "none" ||
+        now < (backpressure.get(obj.trackId)?.retryAfter ?? 0)
       ) {
         continue;
       }
@@ -161,24 +201,33 @@ export function useEnrichment(
         cropH
       );
 
-      const base64 = cropCanvas.toDataURL("image/jpeg", 0.85).split(",")[1];
-
-      const message: WebSocketMessage = {
+      const header: EnrichmentRequestHeader = {
         trackId: obj.trackId,
         label: obj.label,
         confidence: obj.confidence,
-        cropBase64: base64,
       };
 
-      try {
-        ws.send(JSON.stringify(message));
-      } catch (err) {
-        console.error(
-          `Failed to send enrichment request for track ${obj.trackId}:`,
-          err
-        );
-        setEnrichmentStateRef.current(obj.trackId, "error");
-      }
+      // Send the JPEG as raw bytes behind a length-prefixed JSON header —
+      // no base64 expansion on the wire
+      cropCanvas.toBlob(
+        (jpeg) => {
+          if (!jpeg) {
+            setEnrichmentStateRef.current(header.trackId, "error");
+            return;
+          }
+          try {
+            ws.send(new Blob([encodeFrameHeader(header), jpeg]));
+          } catch (err) {
+            console.error(
+              `Failed to send enrichment request for track ${header.trackId}:`,
+              err
+            );
+            setEnrichmentStateRef.current(header.trackId, "error");
+          }
+        },
+        "image/jpeg",
+        0.85
+      );
     }
   }, [trackedObjects, sampleCanvasRef]);
 
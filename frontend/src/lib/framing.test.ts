@@ -0,0 +1,24 @@
+import { describe, it, expect } from "vitest";
+import { encodeFrameHeader } from "./framing";
+
+const header = { trackId: 7, label: "cup", confidence: 0.91 };
+
+describe("encodeFrameHeader", () => {
+  it("prefixes the JSON header with its big-endian byte length", () => {
+    const prefix = encodeFrameHeader(header);
+    const length = new DataView(prefix.buffer).getUint32(0);
+    expect(length).toBe(prefix.length - 4);
+  });
+
+  it("round-trips the header JSON", () => {
+    const prefix = encodeFrameHeader(header);
+    const json = new TextDecoder().decode(prefix.subarray(4));
+    expect(JSON.parse(json)).toEqual(header);
+  });
+
+  it("counts UTF-8 bytes, not UTF-16 code units", () => {
+    const prefix = encodeFrameHeader({ ...header, label: "café" });
+    const length = new DataView(prefix.buffer).getUint32(0);
+    expect(length).toBe(JSON.stringify({ ...header, label: "café" }).length + 1);
+  });
+});
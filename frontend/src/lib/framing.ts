@@ -0,0 +1,18 @@
+import type { EnrichmentRequestHeader } from "../types/index";
+
+const textEncoder = new TextEncoder();
+
+/**
+ * Binary enrichment frame: [4-byte big-endian header length][JSON header][JPEG bytes].
+ * Returns the length prefix + header; the JPEG Blob is appended by the caller
+ * so the browser concatenates it natively without copying into JS memory.
+ */
+export function encodeFrameHeader(
+  header: EnrichmentRequestHeader
+): Uint8Array<ArrayBuffer> {
+  const json = textEncoder.encode(JSON.stringify(header));
+  const prefix = new Uint8Array(4 + json.length);
+  new DataView(prefix.buffer).setUint32(0, json.length);
+  prefix.set(json, 4);
+  return prefix;
+}
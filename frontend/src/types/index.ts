@@ -50,9 +50,9 @@ export interface Enrichment {
   search_query: string;
 }
 
-export interface WebSocketMessage {
+// JSON header of the binary enrichment frame; the JPEG crop follows it raw
+export interface EnrichmentRequestHeader {
   trackId: number;
   label: string;
   confidence: number;
-  cropBase64: string;
 }